@@ -1,16 +1,56 @@
+import os
+import hashlib
+import uuid
+import zipfile
+import multiprocessing
 import pysam
 import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import matplotlib.pyplot as plt
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
 __author__ = "Sam Sims"
 __version__ = "0.1.2"
 
+BASES = ["A", "T", "C", "G"]
+CACHE_DIR = ".ambigviz_cache"
+
+
+def count_coverage_chunk(
+    bam_path, contig, start, stop, quality_threshold, read_callback
+):
+    # Each worker opens its own handle, AlignmentFile is not safe to share
+    with pysam.AlignmentFile(bam_path, "rb") as bam_file:
+        return tuple(
+            np.asarray(counts, dtype=np.int32)
+            for counts in bam_file.count_coverage(
+                contig=contig,
+                start=start,
+                stop=stop,
+                quality_threshold=quality_threshold,
+                read_callback=read_callback,
+            )
+        )
+
 
 class BamVisualiser:
-    def __init__(self, bam):
+    def __init__(
+        self, bam, cache=False, nthreads=1, io_threads=1, read_callback="all"
+    ):
         self.bam_path = bam
-        self.bam_file = pysam.AlignmentFile(bam, "rb")
+        self.cache = cache
+        self.nthreads = nthreads
+        self.io_threads = io_threads
+        self.read_callback = read_callback
+        self.bam_file = pysam.AlignmentFile(bam, "rb", threads=io_threads)
         self.ref_name = self.bam_file.get_reference_name(0)
         self.check_index()
 
@@ -22,40 +62,110 @@ class BamVisualiser:
                 pysam.index(self.bam_path)
                 print("Done!")
                 # Reopen the bam file once indexed
-                self.bam_file = pysam.AlignmentFile(self.bam_path, "rb")
+                self.bam_file = pysam.AlignmentFile(
+                    self.bam_path, "rb", threads=self.io_threads
+                )
             except Exception as e:
                 print(f"Could not index BAM file: {e}")
                 exit(1)
 
-    def pileup(self, positions, min_depth):
-        rows_list = [
-            self.get_base_counts(int(position), min_depth) for position in positions
-        ]
-        pileup_df = pd.DataFrame(rows_list)
-        return pileup_df
-
-    def get_base_counts(self, position, min_depth):
-        base_counts_dict = {"position": position, "A": 0, "T": 0, "C": 0, "G": 0}
-        pileup_columns = self.bam_file.count_coverage(
-            contig=self.ref_name,
-            start=position - 1,
-            stop=position,
-            quality_threshold=0,
+    def coverage_cache_path(self, start, stop, quality_threshold):
+        key = (
+            os.path.abspath(self.bam_path),
+            os.path.getmtime(self.bam_path),
+            self.ref_name,
+            start,
+            stop,
+            quality_threshold,
+            self.read_callback,
         )
-        for base, counts in zip("ATCG", pileup_columns):
-            base_counts_dict[base] = sum(counts)
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(CACHE_DIR, f"{digest}.npz")
 
-        for key in base_counts_dict:
-            if base_counts_dict[key] < min_depth:
-                base_counts_dict[key] = 0
+    def count_coverage(self, start, stop, quality_threshold=0):
+        # Returns A, C, G, T count arrays, reusing a previous scan if cached
+        if self.cache:
+            cache_path = self.coverage_cache_path(start, stop, quality_threshold)
+            if os.path.exists(cache_path):
+                try:
+                    with np.load(cache_path) as cached:
+                        return tuple(cached[base].astype(np.int32) for base in "ACGT")
+                except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                    # Unreadable cache file, drop it and count again
+                    os.remove(cache_path)
 
-        return base_counts_dict
+        if self.nthreads > 1 and stop - start > self.nthreads:
+            # Split the region into contiguous chunks and count them in parallel
+            bounds = np.linspace(start, stop, self.nthreads + 1, dtype=int)
+            # Spawn rather than fork, htslib's decompression threads are
+            # already running in this process
+            with ProcessPoolExecutor(
+                max_workers=self.nthreads,
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                chunks = list(
+                    executor.map(
+                        count_coverage_chunk,
+                        [self.bam_path] * self.nthreads,
+                        [self.ref_name] * self.nthreads,
+                        bounds[:-1].tolist(),
+                        bounds[1:].tolist(),
+                        [quality_threshold] * self.nthreads,
+                        [self.read_callback] * self.nthreads,
+                    )
+                )
+            coverage = tuple(np.concatenate(base) for base in zip(*chunks))
+        else:
+            coverage = tuple(
+                np.asarray(counts, dtype=np.int32)
+                for counts in self.bam_file.count_coverage(
+                    contig=self.ref_name,
+                    start=start,
+                    stop=stop,
+                    quality_threshold=quality_threshold,
+                    read_callback=self.read_callback,
+                )
+            )
+
+        if self.cache:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Write to a uniquely named temp file and move it into place so
+            # readers never see a partially written cache file. Opened with
+            # open() rather than mkstemp so the file mode follows the umask
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "xb") as tmp_file:
+                    np.savez_compressed(tmp_file, **dict(zip("ACGT", coverage)))
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return coverage
+
+    def pileup(self, positions, min_depth):
+        positions = np.fromiter((int(position) for position in positions), np.int64)
+        start, stop = int(positions.min()), int(positions.max())
+        # One count_coverage call over the whole span, sliced per position
+        a, c, g, t = self.count_coverage(start - 1, stop, quality_threshold=0)
+        offsets = positions - start
+        pileup_df = pd.DataFrame({"position": positions})
+        for base, counts in zip(BASES, (a, t, c, g)):
+            counts = counts[offsets]
+            pileup_df[base] = np.where(counts < min_depth, 0, counts)
+        return pileup_df
 
     def plot_pileup(self, df, title, fig_width, individual):
         fig, ax = plt.subplots(figsize=(fig_width, 5))
         colors = ["#60935D", "#E63946", "#1B5299", "#F5BB00"]
 
-        df.plot(x="position", kind="bar", stacked=True, color=colors, ax=ax)
+        x = np.arange(len(df))
+        bottom = np.zeros(len(df))
+        for base, color in zip(df.columns[1:], colors):
+            heights = df[base].to_numpy()
+            ax.bar(x, heights, width=0.5, bottom=bottom, color=color, label=base)
+            bottom += heights
+        ax.set_xticks(x, df["position"], rotation=90)
 
         # Formatting
         ax.set(xlabel="Position", ylabel="Count")
@@ -63,36 +173,70 @@ class BamVisualiser:
         ax.set_title(f"Ambiguous bases in BAM file at positions {title}")
 
         # Annotation
-        bar_order = df.columns[1:][::-1]
-        for idx, row in df.iterrows():
-            if individual:
-                for container in ax.containers:
-                    labels = [
-                        f"{container}: {bar.get_height()}"
-                        if bar.get_height() > 0
-                        else ""
-                        for container, bar in zip(bar_order, container)
-                    ]
-                    ax.bar_label(container, labels=labels, label_type="center", size=8)
-            else:
-                total_count = row[bar_order].sum()
+        if individual:
+            # One label per segment, containers are stacked in column order
+            for base, container in zip(df.columns[1:], ax.containers):
+                labels = [
+                    f"{base}: {count}" if count > 0 else "" for count in df[base]
+                ]
+                ax.bar_label(container, labels=labels, label_type="center", size=8)
+        else:
+            bar_order = df.columns[1:][::-1]
+            counts = df[bar_order].to_numpy()
+            total_counts = counts.sum(axis=1)
+            # Only positions with coverage get a label
+            for x in np.flatnonzero(total_counts):
                 annotation_text = "\n".join(
-                    f"{container}: {count}"
-                    for container, count in zip(bar_order, row[bar_order])
+                    f"{base}: {count}"
+                    for base, count in zip(bar_order, counts[x])
                     if count > 0
                 )
-                x = idx
-                y = total_count / 2
-                ax.annotate(annotation_text, xy=(x, y), ha="center", va="center")
+                ax.annotate(
+                    annotation_text,
+                    xy=(x, total_counts[x] / 2),
+                    ha="center",
+                    va="center",
+                )
 
         return fig
 
     def pileup_percentages(self, pileup_df):
-        total_counts = pileup_df[["A", "T", "C", "G"]].sum(axis=1)
-        percentages_df = pileup_df[["A", "T", "C", "G"]].div(total_counts, axis=0) * 100
-        pileup_df[["A", "T", "C", "G"]] = percentages_df.round(2)
+        counts = pileup_df[BASES].to_numpy(dtype=np.float64)
+        total_counts = counts.sum(axis=1, keepdims=True)
+        # Avoid dividing by zero at positions with no coverage
+        total_counts = np.where(total_counts == 0, 1, total_counts)
+        pileup_df[BASES] = np.round(counts / total_counts * 100, 2)
         return pileup_df
 
+    def save_counts(self, df, path):
+        # pyarrow's C++ CSV writer is much faster on long frames, if available
+        if pa is None:
+            df.to_csv(path, index=False)
+            return
+
+        # Match DataFrame.to_csv output: unquoted header, and whole-number
+        # floats written as "50.0" rather than pyarrow's "50"
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        columns = []
+        for column in table.columns:
+            if pa.types.is_floating(column.type):
+                text = pc.cast(column, pa.string())
+                whole = pc.match_substring_regex(text, r"^-?\d+$")
+                column = pc.if_else(
+                    whole, pc.binary_join_element_wise(text, ".0", ""), text
+                )
+            columns.append(column)
+
+        df.head(0).to_csv(path, index=False)
+        with open(path, "ab") as csv_file:
+            pacsv.write_csv(
+                pa.Table.from_arrays(columns, names=table.column_names),
+                csv_file,
+                write_options=pacsv.WriteOptions(
+                    include_header=False, quoting_style="none"
+                ),
+            )
+
     def visualise(self, args):
         if args.positions:
             positions = args.positions.split(",")
@@ -106,14 +250,21 @@ class BamVisualiser:
         if args.percentages:
             pileup_df = self.pileup_percentages(pileup_df)
 
-        figure_to_plot = self.plot_pileup(
-            pileup_df, title, args.fig_width, args.individual_annotations
-        )
-
         # Outputs
-        figure_to_plot.savefig(args.output, bbox_inches="tight")
+        plot = not args.no_plot
+        if plot and len(pileup_df) > args.max_plot_rows:
+            print(
+                f"Not plotting {len(pileup_df)} positions (more than "
+                f"--max_plot_rows {args.max_plot_rows})"
+            )
+            plot = False
+        if plot:
+            figure_to_plot = self.plot_pileup(
+                pileup_df, title, args.fig_width, args.individual_annotations
+            )
+            figure_to_plot.savefig(args.output, bbox_inches="tight")
         if args.save_counts:
-            pileup_df.to_csv(args.save_counts, index=False)
+            self.save_counts(pileup_df, args.save_counts)
 
     def test(self):
         data = {
@@ -172,13 +323,50 @@ def parse_args():
                         help="Show individual annotations",
                         action="store_true",
     )
+    parser.add_argument("--no_plot",
+                        help="Do not plot, only save counts",
+                        action="store_true",
+    )
+    parser.add_argument("--max_plot_rows",
+                        help="Skip plotting if more positions than this are requested",
+                        default=100000,
+                        type=int
+    )
+    parser.add_argument("--read_callback",
+                        help="Reads to count: 'all' skips unmapped, secondary, "
+                             "QC-failed and duplicate reads, 'nofilter' counts "
+                             "every read",
+                        choices=["all", "nofilter"],
+                        default="all"
+    )
+    parser.add_argument("--nthreads",
+                        help="Number of processes used to count coverage",
+                        default=1,
+                        type=int
+    )
+    parser.add_argument("--io_threads",
+                        help="Number of threads used to decompress the BAM file",
+                        default=max(2, (os.cpu_count() or 1) // 2),
+                        type=int
+    )
+    parser.add_argument("--cache",
+                        help="Cache coverage counts in .ambigviz_cache/ and "
+                             "reuse them on later runs",
+                        action="store_true",
+    )
     return parser.parse_args()
 # fmt: on
 
 
 def main():
     args = parse_args()
-    bam_vis = BamVisualiser(args.bam)
+    bam_vis = BamVisualiser(
+        args.bam,
+        cache=args.cache,
+        nthreads=args.nthreads,
+        io_threads=args.io_threads,
+        read_callback=args.read_callback,
+    )
     bam_vis.visualise(args)
 
 